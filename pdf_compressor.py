@@ -1,20 +1,46 @@
 import os
+import gc
+import atexit
 import io
 import uuid
 import threading
+import queue
 import tempfile
 import logging
 import re
 import time
 import subprocess
 import shutil
-from typing import Optional, Dict, Any, List, Set
-
-from flask import Flask, request, jsonify, send_file, render_template_string, abort
+import glob
+import functools
+import hashlib
+import struct
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Optional, Dict, Any, Iterator, List, Set, Tuple
+
+from flask import Flask, Request, Response, request, jsonify, send_file, render_template_string, abort
+from werkzeug.datastructures import FileStorage
 import fitz  # PyMuPDF
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, UnidentifiedImageError
 import pikepdf
 
+# Optional: pyvips (libvips) shrinks-on-load and resamples in streaming tiles for JPEG output
+try:
+    import pyvips
+except Exception:  # not installed, or the libvips shared library is missing
+    pyvips = None
+
+# Optional: pyahocorasick runs the page keyword scan as a single automaton sweep
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # -----------------------------
 # Logging
 # -----------------------------
@@ -24,16 +50,52 @@ logger = logging.getLogger("pdf-compressor")
 # -----------------------------
 # Flask app
 # -----------------------------
+class UploadRequest(Request):
+    """
+    Writes file uploads straight to files in temp_dir() (instead of Werkzeug's
+    SpooledTemporaryFile) so handlers can use them in place via claim_upload().
+    Uploads no handler claimed are removed when the request ends.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile(dir=temp_dir(), suffix=".pdf", delete=False)
+        self.__dict__.setdefault("upload_paths", []).append(stream.name)
+        return stream
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 # 600 MB hard cap for uploads (server-side). Frontend also checks.
 app.config["MAX_CONTENT_LENGTH"] = 600 * 1024 * 1024
 
-# In-memory job store
-# job_id -> { status, progress, output_buffer, error, created_at, input_path }
+# Page analysis: documents with at least this many pages are classified in a
+# process pool, in batches of ANALYZE_BATCH_PAGES pages per task.
+ANALYZE_PARALLEL_MIN_PAGES = 32
+ANALYZE_BATCH_PAGES = 16
+# Parsed source PDFs kept between /analyze and /compress of the same upload.
+SOURCE_DOC_CACHE_SIZE = 4
+SOURCE_DOC_TTL_SEC = 900
+# Ghostscript is skipped (balanced mode only) for files below GS_MIN_INPUT_BYTES when the
+# image stage already left them at more than GS_SKIP_RATIO of their size: such PDFs are
+# already compact and a GS pass costs seconds for a few percent.
+GS_MIN_INPUT_BYTES = 10 * 1024 * 1024
+GS_SKIP_RATIO = 0.9
+# Jobs each pipeline stage runs side by side (worker threads per stage); capped by physical cores
+PIPELINE_STAGE_WORKERS = 4
+# Upper bound for CPU-bound worker pools; each worker holds a PyMuPDF doc or decoded images.
+MAX_CPU_WORKERS = 8
+# Flush MuPDF's resource store after this many image write-backs (update_stream grows it)
+STORE_SHRINK_EVERY = 32
+
+# In-memory job store, shared by request handlers and pipeline threads: access under jobs_lock
+# job_id -> { status, progress, output_path, error, created_at, input_path, fingerprint }
 jobs: Dict[str, Dict[str, Any]] = {}
+jobs_lock = threading.Lock()
+# Notified on every job update; /events streams wait on it instead of clients polling
+jobs_changed = threading.Condition(jobs_lock)
+# Seconds between SSE keep-alive comments while a job is idle
+EVENTS_KEEPALIVE_SEC = 15
 
 # -----------------------------
-# Frontend (unchanged)
+# Frontend (status pushed over SSE via /events, /status polling as fallback)
 # -----------------------------
 
 HTML_PAGE = """
@@ -332,7 +394,7 @@ HTML_PAGE = """
         .then(data => {
           if (data.error) throw new Error(data.error);
           st.textContent = 'Processing...';
-          pollJobStatus(data.job_id);
+          watchJobStatus(data.job_id);
         })
         .catch(err => {
           st.textContent = 'Error: ' + err.message;
@@ -343,6 +405,35 @@ HTML_PAGE = """
         });
     }
 
+    // Server-pushed status updates; falls back to polling /status if SSE is unavailable
+    function watchJobStatus(jobId) {
+      if (!window.EventSource) {
+        pollJobStatus(jobId);
+        return;
+      }
+      const es = new EventSource(`/events/${jobId}`);
+      es.onmessage = (ev) => {
+        const s = JSON.parse(ev.data);
+        pb.style.width = s.progress + '%';
+        st.textContent = s.status;
+        if (s.status === 'done') {
+          es.close();
+          triggerDownload(jobId);
+        } else if (s.status === 'error') {
+          es.close();
+          st.textContent = 'Error: ' + (s.error || 'Job failed on the server.');
+          pc.style.display = 'none';
+          compressBtn.disabled = false;
+          analyzeBtn.disabled = false;
+          isProcessingQueue = false;
+        }
+      };
+      es.onerror = () => {
+        es.close();
+        pollJobStatus(jobId);
+      };
+    }
+
     function pollJobStatus(jobId) {
       fetch(`/status/${jobId}`)
         .then(r => {
@@ -437,9 +528,210 @@ def cleanup_temp_file(filepath: Optional[str]) -> None:
     except Exception as e:
         logger.warning(f"Failed to cleanup temp file {filepath}: {e}")
 
+@functools.lru_cache(maxsize=1)
+def temp_dir() -> str:
+    """
+    Private working directory for uploads and intermediates, created on first use
+    and removed at interpreter exit so nothing outlives the server.
+    """
+    path = tempfile.mkdtemp(prefix="pdf-compressor-")
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+def make_temp_path(suffix: str = ".pdf") -> str:
+    """
+    Create an empty temp file and return its path; the caller owns cleanup.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=temp_dir()) as t:
+        return t.name
+
+def claim_upload(f: FileStorage) -> str:
+    """
+    Take ownership of an uploaded file's on-disk path (no copy); the caller owns cleanup.
+    """
+    f.stream.close()
+    request.upload_paths.remove(f.stream.name)
+    return f.stream.name
+
+def _update_job(job_id: str, **fields: Any) -> None:
+    """
+    Update a job's fields under jobs_lock; no-op if the job was already cleaned up.
+    """
+    with jobs_changed:
+        job = jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            jobs_changed.notify_all()
+
+def _get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Consistent snapshot of a job's fields, or None.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+# -----------------------------
+# Parsed source cache
+# -----------------------------
+# The frontend uploads the same PDF to /analyze and then /compress. The parsed
+# fitz.Document from the first request is kept (with its own hard link to the
+# file) so the second one skips parsing.
+# fingerprint -> { doc, path, lock, last_used }
+_source_docs: Dict[str, Dict[str, Any]] = {}
+_source_docs_lock = threading.Lock()
+
+def file_fingerprint(path: str, chunk: int = 1024 * 1024) -> str:
+    """
+    Content identity for an uploaded file: blake2b over the whole file. Anything
+    short of the full content could hand one upload another user's cached parse.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _close_source_doc(entry: Dict[str, Any]) -> None:
+    # Waits for any request still reading the document
+    with entry["lock"]:
+        if entry["doc"] is not None:
+            entry["doc"].close()
+            entry["doc"] = None
+        cleanup_temp_file(entry["path"])
+
+@contextlib.contextmanager
+def source_document(path: str, fingerprint: Optional[str] = None) -> Iterator[fitz.Document]:
+    """
+    Read-only fitz.Document for the PDF at path. With a fingerprint the parsed
+    document is cached and reused by later calls for the same file; it is held
+    under a per-document lock while in use. Callers must not modify it.
+    """
+    if not fingerprint:
+        with fitz.open(path) as doc:
+            yield doc
+        return
+
+    evicted = []
+    with _source_docs_lock:
+        entry = _source_docs.get(fingerprint)
+        if entry is None:
+            entry = {"doc": None, "path": None, "lock": threading.Lock(), "last_used": time.time()}
+            _source_docs[fingerprint] = entry
+            while len(_source_docs) > SOURCE_DOC_CACHE_SIZE:
+                oldest = min(_source_docs, key=lambda k: _source_docs[k]["last_used"])
+                evicted.append(_source_docs.pop(oldest))
+        entry["last_used"] = time.time()
+    for old in evicted:
+        _close_source_doc(old)
+
+    with entry["lock"]:
+        with _source_docs_lock:
+            live = _source_docs.get(fingerprint) is entry
+        if not live and entry["doc"] is None:
+            # Evicted (and closed) between the two locks: don't repopulate an entry
+            # nothing will close again
+            with fitz.open(path) as doc:
+                yield doc
+            return
+        if entry["doc"] is None:
+            # Own link to the file: the caller's upload may be deleted before the entry expires
+            entry["path"] = os.path.join(temp_dir(), f"source-{fingerprint}.pdf")
+            cleanup_temp_file(entry["path"])
+            try:
+                os.link(path, entry["path"])
+            except OSError:
+                shutil.copyfile(path, entry["path"])
+            entry["doc"] = fitz.open(entry["path"])
+        yield entry["doc"]
+
+def drop_source_document(fingerprint: Optional[str]) -> None:
+    with _source_docs_lock:
+        entry = _source_docs.pop(fingerprint, None) if fingerprint else None
+    if entry is not None:
+        _close_source_doc(entry)
+
+def expire_source_documents(max_age_sec: int = SOURCE_DOC_TTL_SEC) -> None:
+    now = time.time()
+    with _source_docs_lock:
+        stale = [k for k, e in _source_docs.items() if now - e["last_used"] > max_age_sec]
+        entries = [_source_docs.pop(k) for k in stale]
+    for entry in entries:
+        _close_source_doc(entry)
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    """
+    CPU limit of this container in cores (cgroup v2 cpu.max, else v1 CFS quota),
+    or None when unlimited or not running under a cgroup quota.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=1)
+def _effective_cpus() -> int:
+    """
+    Logical CPUs this process may actually run on: the scheduler affinity mask
+    (os.cpu_count() reports the whole host), capped by a container CPU quota.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        count = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota:
+        count = min(count, math.ceil(quota))
+    return max(1, count)
+
+@functools.lru_cache(maxsize=1)
+def _physical_cores() -> int:
+    """
+    Number of usable physical CPU cores (SMT siblings counted once), capped by
+    _effective_cpus() and MAX_CPU_WORKERS.
+    Sizing CPU-bound pools by logical CPUs oversubscribes cores on SMT hosts.
+    """
+    try:
+        allowed: Optional[Set[int]] = os.sched_getaffinity(0)
+    except AttributeError:
+        allowed = None
+    cores = set()
+    for topo in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology"):
+        cpu = int(os.path.basename(os.path.dirname(topo))[3:])
+        if allowed is not None and cpu not in allowed:
+            continue
+        try:
+            with open(os.path.join(topo, "physical_package_id")) as f:
+                package = f.read().strip()
+            with open(os.path.join(topo, "core_id")) as f:
+                cores.add((package, f.read().strip()))
+        except OSError:
+            continue
+    count = len(cores)
+    if not count:
+        try:
+            import psutil
+            count = psutil.cpu_count(logical=False) or 0
+        except ImportError:
+            count = 0
+    if not count:
+        count = (os.cpu_count() or 2) // 2
+    return max(1, min(count, _effective_cpus(), MAX_CPU_WORKERS))
+
+@functools.lru_cache(maxsize=1)
 def _find_ghostscript_exe() -> Optional[str]:
     """
-    Locate Ghostscript executable across platforms.
+    Locate Ghostscript executable across platforms (resolved once, then cached).
     Returns full path or None if not found.
     """
     # Common names
@@ -450,24 +742,34 @@ def _find_ghostscript_exe() -> Optional[str]:
             return path
     return None
 
-def ghostscript_compress(input_bytes: bytes, extreme: bool = False) -> bytes:
+@functools.lru_cache(maxsize=1)
+def _find_jbig2_exe() -> Optional[str]:
+    """
+    Locate the jbig2enc encoder (resolved once, then cached); None if not installed.
+    """
+    return shutil.which("jbig2")
+
+def ghostscript_compress(input_path: str, extreme: bool = False) -> str:
     """
-    Re-distill via Ghostscript. If GS not available, returns original bytes.
+    Re-distill via Ghostscript into a new temp file and return its path.
+    If GS is not available or fails, returns input_path unchanged.
     'extreme' uses 72 DPI + JBIG2 for mono; 'balanced' uses ~150 DPI.
     """
     gs_exe = _find_ghostscript_exe()
     if not gs_exe:
         logger.warning("Ghostscript not found in PATH; skipping GS compression.")
-        return input_bytes
+        return input_path
 
-    # Base command
+    # Base command. No -dNumRenderingThreads/-dBufferSpace/-dMaxBitmap: they tune
+    # banded raster output and do nothing for pdfwrite, which is single-threaded;
+    # jobs run gs concurrently instead (see PIPELINE_STAGE_WORKERS).
     cmd = [
         gs_exe,
         "-sDEVICE=pdfwrite",
         "-dNOPAUSE",
         "-dQUIET",
         "-dBATCH",
-        "-sOutputFile=%stdout",
+        # Dedupe identical images across pages (e.g. a title-block logo on every sheet)
         "-dDetectDuplicateImages=true",
         "-dColorImageDownsampleType=/Bicubic",
         "-dGrayImageDownsampleType=/Bicubic",
@@ -505,130 +807,287 @@ def ghostscript_compress(input_bytes: bytes, extreme: bool = False) -> bytes:
             "-dMonoImageResolution=600",  # preserve mono linework
         ]
 
-    # Read from stdin, write to stdout
+    # File in, file out: the PDF interpreter needs a seekable input (stdin would be
+    # spooled to a temp file by gs itself) and pdfwrite spools its output anyway, so
+    # pipes would only add copies. gs's own scratch files go to our temp_dir().
+    out_path = make_temp_path()
     try:
-        proc = subprocess.Popen(
-            cmd + ["-"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
+        proc = subprocess.run(
+            cmd + [f"-sOutputFile={out_path}", input_path],
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
+            env={**os.environ, "TMPDIR": temp_dir(), "TEMP": temp_dir()},
         )
-        out, err = proc.communicate(input_bytes)
         if proc.returncode != 0:
-            logger.error(f"Ghostscript failed (code {proc.returncode}): {err.decode(errors='ignore')}")
-            return input_bytes
+            logger.error(f"Ghostscript failed (code {proc.returncode}): {proc.stderr.decode(errors='ignore')}")
+            cleanup_temp_file(out_path)
+            return input_path
+        if os.path.getsize(out_path) == 0:
+            cleanup_temp_file(out_path)
+            return input_path
         logger.info("Ghostscript compression done.")
-        return out if out else input_bytes
+        return out_path
     except Exception as e:
         logger.error(f"Ghostscript error: {e}")
-        return input_bytes
+        cleanup_temp_file(out_path)
+        return input_path
 
-def pikepdf_optimize(input_bytes: bytes) -> bytes:
+def pikepdf_optimize(input_path: str) -> str:
     """
     QPDF/PikePDF pass to shrink structure, enable Fast Web View, compress streams.
+    Opens the file directly (QPDF maps it rather than copying a buffer) and writes
+    a new temp file; returns its path, or input_path unchanged on failure.
     """
+    out_path = make_temp_path()
     try:
-        with pikepdf.open(io.BytesIO(input_bytes)) as pdf:
+        with pikepdf.open(input_path) as pdf:
             pdf.remove_unreferenced_resources()
             # You can also set encryption or object stream tweaks if needed.
-            buf = io.BytesIO()
             pdf.save(
-                buf,
-                optimize_streams=True,
+                out_path,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
                 compress_streams=True,
                 linearize=True,
             )
-            logger.info("PikePDF optimize + linearize complete.")
-            return buf.getvalue()
+        logger.info("PikePDF optimize + linearize complete.")
+        return out_path
     except Exception as e:
         logger.error(f"PikePDF optimize failed: {e}")
-        return input_bytes
+        cleanup_temp_file(out_path)
+        return input_path
 
 # -----------------------------
 # Analysis & Classification
 # -----------------------------
-def analyze_pdf_pages(pdf_path: str) -> Optional[Dict[str, Any]]:
+def analyze_pdf_pages(pdf_path: str, fingerprint: Optional[str] = None) -> Optional[Dict[str, Any]]:
     try:
-        doc = fitz.open(pdf_path)
+        with source_document(pdf_path, fingerprint) as doc:
+            page_count = doc.page_count
+            if page_count < ANALYZE_PARALLEL_MIN_PAGES:
+                results = _classify_doc_pages(doc, 0, page_count)
+            else:
+                results = None
+        if results is None:
+            results = _classify_pages_parallel(pdf_path, page_count)
+
         analysis = {
-            "total_pages": len(doc),
+            "total_pages": page_count,
             "sections": {
                 "architectural": [], "structural": [], "mechanical": [], "electrical": [],
                 "plumbing": [], "landscape": [], "civil": [], "fire_safety": [],
                 "cover_title": [], "details": [], "schedules": [], "other": []
             }
         }
-        for page_num, page in enumerate(doc, start=1):
-            ptype = classify_page(page)
+        for page_num, ptype in results:
             analysis["sections"][ptype].append(page_num)
-        doc.close()
         return analysis
     except Exception as e:
         logger.error(f"Analyze failed: {e}", exc_info=True)
         return None
 
-def classify_page(page: fitz.Page) -> str:
+def _classify_range(pdf_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """
+    Process-pool worker: classify pages [start, end) of the PDF at pdf_path.
+    Opens its own document since fitz.Document objects cannot be shared across processes.
+    Returns 1-based (page_num, ptype) pairs.
+    """
+    with fitz.open(pdf_path) as doc:
+        return _classify_doc_pages(doc, start, end)
+
+def _classify_doc_pages(doc: fitz.Document, start: int, end: int) -> List[Tuple[int, str]]:
+    # Drawing sets almost always use one or two sheet sizes: build each title-block rect once
+    clips: Dict[Tuple[float, float], fitz.Rect] = {}
+    results = []
+    for i in range(start, end):
+        page = doc[i]
+        size = (page.rect.width, page.rect.height)
+        clip = clips.get(size)
+        if clip is None:
+            clip = clips[size] = _title_block_rect(page.rect)
+        results.append((i + 1, classify_page(page, clip)))
+    return results
+
+_analyze_pool: Optional[ProcessPoolExecutor] = None
+_analyze_pool_lock = threading.Lock()
+
+def _analyze_executor() -> ProcessPoolExecutor:
+    """
+    Long-lived process pool for page classification, created on first use.
+    Workers come from a forkserver (spawn where unavailable), never from a fork of
+    this server: it runs pipeline threads inside MuPDF/Pillow, and a forked child
+    could inherit one of their locks held and hang.
+    """
+    global _analyze_pool
+    with _analyze_pool_lock:
+        if _analyze_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _analyze_pool = ProcessPoolExecutor(
+                max_workers=_physical_cores(),
+                mp_context=multiprocessing.get_context(method),
+            )
+        return _analyze_pool
+
+def _discard_analyze_executor(pool: ProcessPoolExecutor) -> None:
+    global _analyze_pool
+    with _analyze_pool_lock:
+        if _analyze_pool is pool:
+            _analyze_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _classify_pages_parallel(pdf_path: str, page_count: int) -> List[Tuple[int, str]]:
+    """
+    Shard page classification across a process pool; falls back to the serial
+    path if the pool cannot be used (e.g. restricted environments).
+    """
+    starts = list(range(0, page_count, ANALYZE_BATCH_PAGES))
+    ends = [min(s + ANALYZE_BATCH_PAGES, page_count) for s in starts]
+    workers = _physical_cores()
+    executor = None
+    try:
+        executor = _analyze_executor()
+        batches = executor.map(
+            _classify_range,
+            [pdf_path] * len(starts),
+            starts,
+            ends,
+            chunksize=max(1, len(starts) // (workers * 4)),
+        )
+        return [item for batch in batches for item in batch]
+    except Exception as e:
+        if executor is not None:
+            # The pool may be broken (e.g. a worker died); start a fresh one next time
+            _discard_analyze_executor(executor)
+        logger.warning(f"Parallel analyze failed, falling back to serial: {e}")
+        return _classify_range(pdf_path, 0, page_count)
+
+# Sheet-number prefixes and keywords per discipline. Dict order is priority
+# order: when several match, the earliest entry wins.
+SHEET_PATTERNS = {
+    "cover_title": r"\b[G][ -.]?\d",
+    "architectural": r"\b[A][ -.]?\d",
+    "structural": r"\b[S][ -.]?\d",
+    "mechanical": r"\b[M][ -.]?\d",
+    "electrical": r"\b[E][ -.]?\d",
+    "plumbing": r"\b[P][ -.]?\d",
+    "landscape": r"\b[L][ -.]?\d",
+    "civil": r"\b[C][ -.]?\d",
+    "fire_safety": r"\b[F][P]?[ -.]?\d",
+}
+DISCIPLINE_KEYWORDS = {
+    "fire_safety": ["FIRE PROTECTION", "FIRE ALARM", "SPRINKLER", "EGRESS"],
+    "mechanical": ["HVAC", "MECHANICAL", "DUCTWORK"],
+    "electrical": ["ELECTRICAL", "LIGHTING", "PANEL", "ONE-LINE"],
+    "plumbing": ["PLUMBING", "SANITARY", "STORM DRAIN", "RISER DIAGRAM"],
+    "civil": ["CIVIL", "GRADING", "UTILITIES", "SITE PLAN"],
+    "architectural": ["FLOOR PLAN", "ELEVATION", "ARCHITECTURAL"],
+    "structural": ["STRUCTURAL", "FOUNDATION", "FRAMING"],
+    "landscape": ["LANDSCAPE", "PLANTING", "IRRIGATION"],
+}
+GENERAL_KEYWORDS = {
+    "cover_title": ["COVER", "SHEET INDEX", "GENERAL NOTES", "LEGEND", "ABBREVIATIONS"],
+    "schedules": ["SCHEDULE", "DOOR SCHEDULE", "WINDOW SCHEDULE", "FINISH SCHEDULE"],
+    "details": ["DETAIL", "CONNECTION", "ASSEMBLY", "SECTION DETAIL"],
+}
+
+# One alternation per phase, one named group per category (group number == priority).
+# Case-insensitive, matched against casefolded page text (which, like the old upper()
+# copy, expands ligatures such as U+FB02 "fl" that IGNORECASE alone would not).
+_SHEET_RE = re.compile("|".join(f"(?P<{k}>{p})" for k, p in SHEET_PATTERNS.items()), re.IGNORECASE)
+# Keywords are wrapped in a lookahead so overlapping hits are all seen.
+_KEYWORD_RE = re.compile(
+    "(?=" + "|".join(
+        f"(?P<{k}>" + "|".join(re.escape(w) for w in words) + ")"
+        for k, words in list(DISCIPLINE_KEYWORDS.items()) + list(GENERAL_KEYWORDS.items())
+    ) + ")",
+    re.IGNORECASE,
+)
+
+def _build_keyword_automaton():
+    """
+    Aho-Corasick automaton over all keywords, casefolded; values are (priority, category).
+    None when pyahocorasick is not installed.
+    """
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    categories = list(DISCIPLINE_KEYWORDS.items()) + list(GENERAL_KEYWORDS.items())
+    for rank, (k, words) in enumerate(categories):
+        for w in words:
+            automaton.add_word(w.casefold(), (rank, k))
+    automaton.make_automaton()
+    return automaton
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+def _best_keyword_category(text: str) -> Optional[str]:
+    """
+    Highest-priority keyword category found in already-casefolded text: one
+    O(len(text)) automaton sweep when pyahocorasick is available, else the
+    compiled keyword alternation.
+    """
+    if _KEYWORD_AUTOMATON is None:
+        return _best_category(_KEYWORD_RE, text)
+    best = None
+    for _, (rank, k) in _KEYWORD_AUTOMATON.iter(text):
+        if best is None or rank < best[0]:
+            best = (rank, k)
+            if rank == 0:
+                break
+    return best[1] if best else None
+
+def _best_category(regex: "re.Pattern[str]", text: str) -> Optional[str]:
+    """
+    Single scan of text; returns the highest-priority category that matched anywhere.
+    """
+    best, best_rank = None, 0
+    for m in regex.finditer(text):
+        rank = regex.groupindex[m.lastgroup]
+        if best is None or rank < best_rank:
+            best, best_rank = m.lastgroup, rank
+            if rank == 1:
+                break
+    return best
+
+def _title_block_rect(page_rect: fitz.Rect) -> fitz.Rect:
+    """
+    Bottom-right 30% x 30% of the page, where the title block sits.
+    """
+    return fitz.Rect(page_rect.width * 0.7, page_rect.height * 0.7, page_rect.width, page_rect.height)
+
+def classify_page(page: fitz.Page, clip_rect: Optional[fitz.Rect] = None) -> str:
     """
     Heuristic classifier driven by title-block corner text + whole page text.
+    clip_rect is the title-block area; computed from the page size when omitted.
     """
     try:
-        page_rect = page.rect
-        br = fitz.Rect(page_rect.width * 0.7, page_rect.height * 0.7, page_rect.width, page_rect.height)
-        corner_text = (page.get_text("text", clip=br, sort=True) or "").upper()
-        full_text = (page.get_text("text", sort=True) or "").upper()
+        br = clip_rect if clip_rect is not None else _title_block_rect(page.rect)
+        corner_text = (page.get_text("text", clip=br, sort=True) or "").casefold()
     except Exception:
-        corner_text, full_text = "", ""
-
-    patterns = {
-        "cover_title": r"\b[G][ -.]?\d",
-        "architectural": r"\b[A][ -.]?\d",
-        "structural": r"\b[S][ -.]?\d",
-        "mechanical": r"\b[M][ -.]?\d",
-        "electrical": r"\b[E][ -.]?\d",
-        "plumbing": r"\b[P][ -.]?\d",
-        "landscape": r"\b[L][ -.]?\d",
-        "civil": r"\b[C][ -.]?\d",
-        "fire_safety": r"\b[F][P]?[ -.]?\d",
-    }
-    for k, pat in patterns.items():
-        if re.search(pat, corner_text):
-            return k
-    for k, pat in patterns.items():
-        if re.search(pat, full_text):
-            return k
-
-    discipline_keywords = {
-        "fire_safety": ["FIRE PROTECTION", "FIRE ALARM", "SPRINKLER", "EGRESS"],
-        "mechanical": ["HVAC", "MECHANICAL", "DUCTWORK"],
-        "electrical": ["ELECTRICAL", "LIGHTING", "PANEL", "ONE-LINE"],
-        "plumbing": ["PLUMBING", "SANITARY", "STORM DRAIN", "RISER DIAGRAM"],
-        "civil": ["CIVIL", "GRADING", "UTILITIES", "SITE PLAN"],
-        "architectural": ["FLOOR PLAN", "ELEVATION", "ARCHITECTURAL"],
-        "structural": ["STRUCTURAL", "FOUNDATION", "FRAMING"],
-        "landscape": ["LANDSCAPE", "PLANTING", "IRRIGATION"],
-    }
-    for k, words in discipline_keywords.items():
-        if any(w in full_text for w in words):
-            return k
-
-    general = {
-        "cover_title": ["COVER", "SHEET INDEX", "GENERAL NOTES", "LEGEND", "ABBREVIATIONS"],
-        "schedules": ["SCHEDULE", "DOOR SCHEDULE", "WINDOW SCHEDULE", "FINISH SCHEDULE"],
-        "details": ["DETAIL", "CONNECTION", "ASSEMBLY", "SECTION DETAIL"],
-    }
-    for k, words in general.items():
-        if any(w in full_text for w in words):
-            return k
+        corner_text = ""
+    found = _best_category(_SHEET_RE, corner_text)
+    if found:
+        return found
 
-    return "other"
+    # Whole-page text only when the title block did not identify the sheet
+    try:
+        full_text = (page.get_text("text", sort=True) or "").casefold()
+    except Exception:
+        full_text = ""
+    return (
+        _best_category(_SHEET_RE, full_text)
+        or _best_keyword_category(full_text)
+        or "other"
+    )
 
 # -----------------------------
 # Image recompression
 # -----------------------------
-def _resample_image(pil_img: Image.Image, max_dim: int, mode: str, quality: int, extreme: bool) -> bytes:
+def _resample_image(
+    pil_img: Image.Image, max_dim: int, mode: str, quality: int, extreme: bool, jbig2: bool = True
+) -> bytes:
     """
     Convert, resample and encode an image for PDF embedding.
-    - For extreme/line art: 1-bit TIFF G4
+    - For extreme/line art: 1-bit JBIG2 (via jbig2enc if installed and jbig2), else TIFF G4
     - For others: JPEG (RGB/Gray) with given quality
     """
     # Ensure exif transforms applied
@@ -637,39 +1096,668 @@ def _resample_image(pil_img: Image.Image, max_dim: int, mode: str, quality: int,
     except Exception:
         pass
 
-    # Downscale
+    # Drop alpha/palette/CMYK up front: resampling then runs on the final channels only
+    # (one for bilevel and general output), and LANCZOS is not restricted to NEAREST
+    # as it is for "P" and "1" images.
+    bilevel = extreme or mode == "line_art"
+    target_mode = "L" if bilevel or mode == "general" else "RGB"
+    if pil_img.mode != target_mode:
+        pil_img = pil_img.convert(target_mode)
+
+    # Downscale: integer box-reduce to within 2x of the target first (cheap, in C),
+    # so the LANCZOS pass only convolves an image at most twice the output size
     if max(pil_img.width, pil_img.height) > max_dim:
-        pil_img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        pil_img.thumbnail((max_dim, max_dim), Image.LANCZOS, reducing_gap=2.0)
 
     # Choose encoding
-    if extreme or mode == "line_art":
-        # Ensure bilevel
-        img_mono = pil_img.convert("1")
+    if bilevel:
+        # Ensure bilevel; plain threshold, CAD linework gains nothing from dithering
+        img_mono = pil_img.convert("1", dither=Image.NONE)
+        jbig2_bytes = _jbig2_encode(img_mono) if jbig2 else None
+        if jbig2_bytes:
+            return jbig2_bytes
         out = io.BytesIO()
-        img_mono.save(out, format="TIFF", compression="group4")
+        # One strip for the whole image so the G4 data can be embedded as a single CCITT stream
+        img_mono.save(
+            out,
+            format="TIFF",
+            compression="group4",
+            strip_size=(img_mono.width + 7) // 8 * img_mono.height,
+        )
         return out.getvalue()
     else:
-        # General / mixed: choose Gray for general, RGB for mixed
-        if mode == "general":
-            pil_img = pil_img.convert("L")
-        else:
-            pil_img = pil_img.convert("RGB")
+        # General / mixed: already Gray for general, RGB for mixed
         out = io.BytesIO()
-        pil_img.save(out, format="JPEG", optimize=True, quality=max(20, min(95, quality)))
+        # Baseline 4:2:0 keeps libjpeg-turbo (bundled with Pillow) on its SIMD paths
+        # (ignored for "L"); optimize=True builds per-image Huffman tables
+        pil_img.save(
+            out,
+            format="JPEG",
+            optimize=True,
+            quality=max(20, min(95, quality)),
+            subsampling=2,
+            progressive=False,
+        )
         return out.getvalue()
 
-def _collect_unique_image_xrefs(doc: fitz.Document) -> List[int]:
-    xrefs: Set[int] = set()
-    for page in doc:
-        for info in page.get_images(full=True):
-            # info[0] is xref
-            xrefs.add(info[0])
-    return list(xrefs)
+def _jbig2_encode(img_mono: Image.Image) -> Optional[bytes]:
+    """
+    Encode a 1-bit image as an embeddable JBIG2 stream (jbig2enc generic region,
+    PDF mode: no file header or end segments). None if jbig2enc is unavailable or fails.
+    """
+    jbig2_exe = _find_jbig2_exe()
+    if not jbig2_exe:
+        return None
+    # jbig2enc reads images from files only
+    pbm_path = make_temp_path(suffix=".pbm")
+    try:
+        img_mono.save(pbm_path, format="PPM")
+        proc = subprocess.run([jbig2_exe, "-p", pbm_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0 or not proc.stdout:
+            logger.warning(f"jbig2enc failed (code {proc.returncode}): {proc.stderr.decode(errors='ignore')}")
+            return None
+        return proc.stdout
+    except Exception as e:
+        logger.warning(f"jbig2enc error: {e}")
+        return None
+    finally:
+        cleanup_temp_file(pbm_path)
+
+def _jbig2_page_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) from the page-information segment that opens an embedded
+    JBIG2 stream, or None if data does not start with one.
+    """
+    # Segment header: number(4), flags(1), referred-to count(1), page(1 or 4), length(4)
+    if len(data) < 19 or data[4] & 0x3F != 48 or data[5] >> 5:
+        return None
+    offset = 14 if data[4] & 0x40 else 11
+    return struct.unpack(">II", data[offset:offset + 8])
+
+def _iter_unique_image_xrefs(doc: fitz.Document) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (page number, xref) for each unique image, page by page in first-use order
+    (ascending xref within a page). Document.get_page_images(full=False) reads page
+    resources without loading Page objects.
+    """
+    seen: Set[int] = set()
+    for pno in range(doc.page_count):
+        # info[0] is xref; set difference drops images already seen on earlier pages
+        # (a title block repeated on every sheet) without a per-image Python check
+        new = {info[0] for info in doc.get_page_images(pno, full=False)}
+        new.difference_update(seen)
+        if new:
+            seen.update(new)
+            for xref in sorted(new):
+                yield pno, xref
+
+def _extract_image_bytes(doc: fitz.Document, xref: int) -> Optional[bytes]:
+    """
+    Encoded bytes of image xref, or None if it should be left untouched.
+    """
+    try:
+        # Stencil masks take the fill color; re-encoding them as images would change rendering
+        if doc.xref_get_key(xref, "ImageMask")[1] == "true":
+            return None
+        base = doc.extract_image(xref)
+        return (base.get("image") if base else None) or None
+    except Exception as e:
+        logger.warning(f"Image xref {xref} extract skipped: {e}")
+        return None
+
+def _is_compact_jpeg(doc: fitz.Document, xref: int, max_dim: int, mode: str) -> bool:
+    """
+    True if image xref is already a JPEG within max_dim in the colour model the mode
+    would produce, so re-encoding would only cost CPU and quality.
+    Reads the image dictionary only; the stream is not extracted.
+    """
+    try:
+        if doc.xref_get_key(xref, "Filter")[1] != "/DCTDecode":
+            return False
+        width = int(doc.xref_get_key(xref, "Width")[1])
+        height = int(doc.xref_get_key(xref, "Height")[1])
+    except Exception:
+        return False
+    if max(width, height) > max_dim:
+        return False
+    # general mode converts to grayscale, which is worth doing for colour JPEGs
+    return mode != "general" or doc.xref_get_key(xref, "ColorSpace")[1] == "/DeviceGray"
+
+def _vips_resample(img_bytes: bytes, max_dim: int, mode: str, quality: int) -> Optional[bytes]:
+    """
+    JPEG branch of _resample_image done by libvips: shrink-on-load + streaming resize,
+    so the full-size decoded image is never held in memory.
+    Returns None when pyvips is unavailable or cannot handle the image.
+    """
+    if pyvips is None:
+        return None
+    try:
+        # Autorotates like exif_transpose; size="down" never upscales
+        vim = pyvips.Image.thumbnail_buffer(img_bytes, max_dim, height=max_dim, size="down")
+        vim = vim.colourspace("b-w" if mode == "general" else "srgb")
+        if vim.hasalpha():
+            vim = vim.extract_band(0, n=vim.bands - 1)
+        return vim.jpegsave_buffer(
+            Q=max(20, min(95, quality)),
+            optimize_coding=True,
+            strip=True,
+            interlace=False,
+            subsample_mode="on",
+        )
+    except Exception as e:
+        logger.warning(f"libvips resample failed, using Pillow: {e}")
+        return None
+
+def _recompress_image(
+    img_bytes: bytes, max_dim: int, mode: str, quality: int, extreme: bool, jbig2: bool = True
+) -> bytes:
+    """
+    Thread-pool worker: decode extracted image bytes and run _resample_image.
+    Pure Pillow/libvips work (no fitz.Document access), so it is safe to run concurrently.
+    BytesIO over a bytes object shares its buffer, so decoding makes no extra copy.
+    """
+    if not (extreme or mode == "line_art"):
+        data = _vips_resample(img_bytes, max_dim, mode, quality)
+        if data is not None:
+            return data
+    with Image.open(io.BytesIO(img_bytes)) as im:
+        longest = max(im.width, im.height)
+        if im.format == "JPEG" and longest > max_dim * 2:
+            # Let libjpeg IDCT at 1/2..1/8 scale, keeping at least 2x the target size
+            # for the LANCZOS pass; grayscale output also skips chroma decoding.
+            scale = max_dim * 2 / longest
+            im.draft(
+                "L" if mode == "general" else im.mode,
+                (max(1, int(im.width * scale)), max(1, int(im.height * scale))),
+            )
+        return _resample_image(
+            pil_img=im, max_dim=max_dim, mode=mode, quality=quality, extreme=extreme, jbig2=jbig2
+        )
+
+def _replace_image_stream(doc: fitz.Document, xref: int, data: bytes) -> None:
+    """
+    Store an image encoded by _resample_image (JPEG, TIFF G4 or JBIG2) as the stream
+    of image object xref, rewriting the image dictionary to describe the new data.
+    """
+    jbig2_size = None
+    try:
+        im = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        jbig2_size = _jbig2_page_size(data)
+        if jbig2_size is None:
+            raise
+
+    if jbig2_size:
+        width, height = jbig2_size
+        raw, filt, parms = data, "/JBIG2Decode", None
+        colorspace, bpc = "/DeviceGray", 1
+    else:
+        with im:
+            width, height = im.size
+            if im.format == "JPEG":
+                raw, filt, parms = data, "/DCTDecode", None
+                colorspace = "/DeviceGray" if im.mode == "L" else "/DeviceRGB"
+                bpc = 8
+            else:
+                offsets, counts = im.tag_v2.get(273), im.tag_v2.get(279)
+                if offsets and counts and len(offsets) == 1:
+                    # Single G4 strip is a valid CCITTFaxDecode stream as-is
+                    raw = data[offsets[0]:offsets[0] + counts[0]]
+                    filt = "/CCITTFaxDecode"
+                    parms = f"<</K -1/Columns {width}/Rows {height}/BlackIs1 true>>"
+                else:
+                    raw, filt, parms = im.tobytes(), None, None
+                colorspace, bpc = "/DeviceGray", 1
+
+    # compress=False drops the old /Filter and /DecodeParms along with the old data
+    doc.update_stream(xref, raw, compress=filt is None)
+    if filt:
+        doc.xref_set_key(xref, "Filter", filt)
+    if parms:
+        doc.xref_set_key(xref, "DecodeParms", parms)
+    doc.xref_set_key(xref, "Width", str(width))
+    doc.xref_set_key(xref, "Height", str(height))
+    doc.xref_set_key(xref, "ColorSpace", colorspace)
+    doc.xref_set_key(xref, "BitsPerComponent", str(bpc))
+    _drop_stale_image_keys(doc, xref)
+
+# Image dictionary keys written by _replace_image_stream
+_REPLACED_IMAGE_KEYS = ("Filter", "DecodeParms", "Width", "Height", "ColorSpace", "BitsPerComponent")
+
+def _copy_image_stream(doc: fitz.Document, src: int, xref: int) -> None:
+    """
+    Give image xref the stream already written to src by _replace_image_stream
+    (same source bytes, so same result) without keeping or re-parsing the encoded data.
+    """
+    # compress=False drops xref's old /Filter and /DecodeParms; src's are copied below
+    doc.update_stream(xref, doc.xref_stream_raw(src), compress=False)
+    for key in _REPLACED_IMAGE_KEYS:
+        kind, value = doc.xref_get_key(src, key)
+        if kind != "null":
+            doc.xref_set_key(xref, key, value)
+    _drop_stale_image_keys(doc, xref)
+
+def _drop_stale_image_keys(doc: fitz.Document, xref: int) -> None:
+    # Decode arrays and color-key (array) masks refer to the old color space; an
+    # explicit /Mask stream, like /SMask, stays valid for the resampled image
+    if doc.xref_get_key(xref, "Decode")[0] != "null":
+        doc.xref_set_key(xref, "Decode", "null")
+    if doc.xref_get_key(xref, "Mask")[0] == "array":
+        doc.xref_set_key(xref, "Mask", "null")
 
 # -----------------------------
 # Core processing pipeline
 # -----------------------------
-def process_job(
+# Jobs flow through four stages connected by queues, each served by a bounded set
+# of worker threads (see _stage_worker_count), so several jobs run side by side
+# and consecutive jobs overlap (e.g. one job in Ghostscript while the next
+# recompresses images). Tasks carry disk paths, never PDF bytes.
+#
+# task -> { job_id, input_pdf, fingerprint, path, quality, max_dimension, drawing_mode,
+#           extract_pages, extreme_compression, pre_image_bytes }
+
+def _set_task_path(task: Dict[str, Any], path: str) -> None:
+    """
+    Point the task at a stage's output file, removing the previous intermediate.
+    """
+    old = task["path"]
+    if path != old:
+        if old != task["input_pdf"]:
+            cleanup_temp_file(old)
+        task["path"] = path
+
+def _stage_subset(task: Dict[str, Any]) -> None:
+    """
+    1) Subset pages if requested, 2) strip annotations/JS in extreme mode.
+    """
+    job_id = task["job_id"]
+    extract_pages = task["extract_pages"]
+    _update_job(job_id, status="Initializing...", progress=5)
+
+    with source_document(task["input_pdf"], task.get("fingerprint")) as src:
+        if extract_pages:
+            keep = [p - 1 for p in extract_pages]  # incoming pages are 1-based
+            keep = [p for p in keep if 0 <= p < src.page_count]
+            if not keep:
+                raise ValueError("No valid pages selected.")
+            status_label = f"Extracting {len(keep)} selected pages..."
+        else:
+            keep = list(range(src.page_count))
+            status_label = "Processing all pages..."
+        all_pages = keep == list(range(src.page_count))
+
+        _update_job(job_id, status=status_label, progress=10)
+
+        if all_pages and not task["extreme_compression"]:
+            # Nothing to subset or clean: the image stage reads the upload directly
+            return
+
+        if not all_pages:
+            with fitz.open() as work:
+                _insert_page_runs(work, src, keep)
+                if task["extreme_compression"]:
+                    _strip_annotations_and_js(work, job_id)
+                subset_path = make_temp_path()
+                work.save(subset_path)
+
+    if all_pages:
+        # Keeping every page: clean a private copy of the source instead of copying pages
+        with fitz.open(task["input_pdf"]) as work:
+            _strip_annotations_and_js(work, job_id)
+            subset_path = make_temp_path()
+            work.save(subset_path)
+    _set_task_path(task, subset_path)
+
+def _strip_annotations_and_js(work: fitz.Document, job_id: str) -> None:
+    """
+    2) Extreme-mode cleanup: drop annotations and embedded JavaScript files.
+    """
+    _update_job(job_id, status="Cleaning annotations & attachments...", progress=15)
+    try:
+        for page in work:
+            # Freeze the iterator before deleting; broadly remove visual annotations (safer size)
+            for a in list(page.annots() or []):
+                page.delete_annot(a)
+    except Exception as e:
+        logger.warning(f"Annot cleanup warning: {e}")
+
+    # Remove embedded JS files if any
+    try:
+        count = work.embfile_count()
+        for i in range(count - 1, -1, -1):
+            info = work.embfile_info(i)
+            fname = (info.get("filename") or "").lower() if info else ""
+            if fname.endswith(".js"):
+                logger.info(f"Removing embedded JS: {fname}")
+                work.embfile_del(i)
+    except Exception as e:
+        logger.warning(f"Embed cleanup warning: {e}")
+
+def _insert_page_runs(work: fitz.Document, src: fitz.Document, keep: List[int]) -> None:
+    """
+    Append pages keep (0-based, in order) of src to work, one insert_pdf call per contiguous run.
+    """
+    for _, run in itertools.groupby(enumerate(keep), key=lambda t: t[1] - t[0]):
+        pages = [p for _, p in run]
+        _insert_page_range(work, src, pages[0], pages[-1])
+
+def _insert_page_range(work: fitz.Document, src: fitz.Document, lo: int, hi: int) -> None:
+    before = work.page_count
+    try:
+        work.insert_pdf(src, from_page=lo, to_page=hi)
+    except ValueError as e:
+        # Links are resolved after the pages are copied; drop any partial insert before retrying
+        if work.page_count > before:
+            work.delete_pages(from_page=before, to_page=work.page_count - 1)
+        if lo < hi:
+            # Split the run to isolate the offending page(s)
+            mid = (lo + hi) // 2
+            _insert_page_range(work, src, lo, mid)
+            _insert_page_range(work, src, mid + 1, hi)
+            return
+        # Some PDFs contain malformed link destinations like
+        # "1&view=Fit" which PyMuPDF attempts to parse as a
+        # page number and raises ValueError. Fall back to
+        # copying the page without link metadata so the job
+        # can still complete.
+        logger.warning(
+            "Page %s has invalid link metadata; copying without links (%s)",
+            lo + 1,
+            e,
+        )
+        work.insert_pdf(src, from_page=lo, to_page=hi, links=False)
+
+def _scanned_page_image_size(page: fitz.Page) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) of the page's image if the page is a plain scan: a single image
+    covering (nearly) the whole page and nothing else - no text, no vector drawings
+    (CAD linework and outlined SHX text over a raster underlay), no annotations or
+    form fields or links. None otherwise.
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.first_annot is not None or page.first_widget is not None:
+        return None
+    # first_annot skips /Link annotations; rebuilt pages would lose them
+    if page.first_link is not None:
+        return None
+    if page.get_text("text").strip() or page.get_cdrawings():
+        return None
+    # get_image_info() without hashes/xrefs reports placements without decoding pixels
+    placed = page.get_image_info()
+    if len(placed) != 1 or fitz.Rect(placed[0]["bbox"]).get_area() < 0.9 * page.rect.get_area():
+        return None
+    return images[0][2], images[0][3]
+
+def _rasterize_scanned_document(task: Dict[str, Any]) -> Optional[str]:
+    """
+    Fast path for JPEG output of documents made only of oversized page scans: render
+    each page once with MuPDF at the target resolution and JPEG-encode the pixmap,
+    instead of extract -> PIL decode -> resample -> update_stream per image.
+    Returns the new PDF's path, or None when the document does not qualify.
+    """
+    max_dim = task["max_dimension"]
+    with fitz.open(task["path"]) as work:
+        sizes = []
+        for page in work:
+            size = _scanned_page_image_size(page)
+            # Scans already within max_dim are better left to the per-xref path,
+            # which keeps compact JPEGs untouched
+            if size is None or max(size) <= max_dim:
+                return None
+            sizes.append(size)
+        if not sizes:
+            return None
+
+        colorspace = fitz.csGRAY if task["drawing_mode"] == "general" else fitz.csRGB
+        quality = max(20, min(95, task["quality"]))
+        with fitz.open() as out:
+            for pno, (page, size) in enumerate(zip(work, sizes)):
+                rect = page.rect
+                longest = max(rect.width, rect.height)
+                # Never above the scan's own resolution, never above max_dim pixels
+                zoom = min(max(size) / longest, max_dim / longest)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+                new_page = out.new_page(width=rect.width, height=rect.height)
+                new_page.insert_image(new_page.rect, stream=pix.tobytes("jpg", jpg_quality=quality))
+                del pix
+                _update_job(task["job_id"], progress=20 + int(((pno + 1) / len(sizes)) * 60))
+            out.set_toc(work.get_toc())
+            out.set_metadata(work.metadata)
+            labels = work.get_page_labels()
+            if labels:
+                out.set_page_labels(labels)
+            _update_job(task["job_id"], status="Saving (PyMuPDF)...", progress=82)
+            out_path = make_temp_path()
+            out.save(out_path, garbage=4, deflate=True, clean=True)
+    logger.info(f"Rasterized {len(sizes)} scanned pages.")
+    return out_path
+
+def _stage_recompress_images(task: Dict[str, Any]) -> None:
+    """
+    3) Image recompression, 4) save a compacted intermediate PDF.
+    """
+    job_id = task["job_id"]
+    _update_job(job_id, status="Recompressing images...", progress=20)
+
+    task["pre_image_bytes"] = os.path.getsize(task["path"])
+    bilevel = task["extreme_compression"] or task["drawing_mode"] == "line_art"
+    if not bilevel:
+        raster_path = _rasterize_scanned_document(task)
+        if raster_path is not None:
+            fitz.TOOLS.store_shrink(100)
+            _set_task_path(task, raster_path)
+            return
+
+    # In extreme mode Ghostscript always runs and decodes/re-encodes every image, so
+    # the 1-bit images only need a cheap lossless handoff format (G4), not jbig2enc.
+    gs_redistills = task["extreme_compression"] and _find_ghostscript_exe() is not None
+    with fitz.open(task["path"]) as work:
+        page_count = max(1, work.page_count)
+
+        # fitz.Document is not thread-safe: xref discovery, extraction and stream updates
+        # stay on this thread, only decode/resample/encode (GIL-releasing Pillow work) is
+        # pooled. Images are discovered page by page while earlier ones are encoding.
+        # At most `window` images are in flight, and results are written back in
+        # completion order (stream updates are order-independent), so one slow image
+        # does not hold up the others and memory stays flat however many images there are.
+        # Byte-identical images under different xrefs (logos, title blocks) are encoded
+        # once: while the first one is in flight, duplicates join its xref list; after
+        # it is written back, by_digest names that xref and duplicates copy its stream
+        # from the document, so no encoded result outlives the window.
+        workers = _physical_cores()
+        window = workers * 2
+        pending: Dict[Future, Tuple[bytes, List[int]]] = {}
+        in_flight: Dict[bytes, Future] = {}
+        by_digest: Dict[bytes, Optional[int]] = {}
+        processed = written = seen = 0
+        pages_scanned = 0
+        progress = 20
+
+        def write_back(xref: int, fut: Optional[Future], src: Optional[int] = None) -> bool:
+            nonlocal processed, written
+            ok = False
+            try:
+                if src is not None:
+                    _copy_image_stream(work, src, xref)
+                else:
+                    _replace_image_stream(work, xref, fut.result())
+                ok = True
+            except Exception as e:
+                logger.warning(f"Image xref {xref} recompress skipped: {e}")
+            processed += 1
+            written += 1
+            if written % STORE_SHRINK_EVERY == 0:
+                fitz.TOOLS.store_shrink(100)
+            return ok
+
+        def collect(return_when: str) -> None:
+            nonlocal progress
+            done, _ = wait(pending, return_when=return_when)
+            for fut in done:
+                digest, xrefs = pending.pop(fut)
+                del in_flight[digest]
+                first = xrefs[0]
+                # Failed encodes are remembered as None so duplicates are skipped too
+                by_digest[digest] = first if write_back(first, fut) else None
+                for xref in xrefs[1:]:
+                    write_back(xref, fut)
+            # progress to ~80%: share of discovered images done, scaled by the share of
+            # pages scanned so far; never moves backwards as more images turn up
+            share = (processed / max(1, seen)) * (pages_scanned / page_count)
+            progress = max(progress, 20 + int(share * 60))
+            _update_job(job_id, progress=progress)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for pno, xref in _iter_unique_image_xrefs(work):
+                seen += 1
+                pages_scanned = pno
+                if not bilevel and _is_compact_jpeg(work, xref, task["max_dimension"], task["drawing_mode"]):
+                    processed += 1
+                    continue
+                img_bytes = _extract_image_bytes(work, xref)
+                if img_bytes is None:
+                    processed += 1
+                    continue
+                digest = hashlib.sha1(img_bytes, usedforsecurity=False).digest()
+                if digest in in_flight:
+                    pending[in_flight[digest]][1].append(xref)
+                    continue
+                if digest in by_digest:
+                    src = by_digest[digest]
+                    if src is None:
+                        processed += 1
+                    else:
+                        write_back(xref, None, src)
+                    continue
+                fut = pool.submit(
+                    _recompress_image,
+                    img_bytes,
+                    task["max_dimension"],
+                    task["drawing_mode"],
+                    task["quality"],
+                    task["extreme_compression"],
+                    not gs_redistills,
+                )
+                pending[fut] = (digest, [xref])
+                in_flight[digest] = fut
+                del img_bytes
+                if len(pending) >= window:
+                    collect(FIRST_COMPLETED)
+            pages_scanned = page_count
+            if pending:
+                collect(ALL_COMPLETED)
+        fitz.TOOLS.store_shrink(100)
+        logger.info(f"Processed {seen} unique images ({len(by_digest)} distinct encodes).")
+
+        # 4) Save intermediate PDF to disk (compact structure)
+        _update_job(job_id, status="Saving (PyMuPDF)...", progress=82)
+        pymupdf_path = make_temp_path()
+        if gs_redistills:
+            # Ghostscript always re-distills in extreme mode and re-encodes every
+            # stream, so deflating and cleaning content streams here would be thrown
+            # away; still dedupe objects so gs has less to parse.
+            work.save(pymupdf_path, garbage=4)
+        else:
+            # garbage >= 4 does aggressive xref cleanup; deflate compresses streams; clean removes unused
+            work.save(pymupdf_path, garbage=4, deflate=True, clean=True)
+    # update_stream leaves decoded images in MuPDF's resource store; drop them (and
+    # the closed document's Python wrappers) before the Ghostscript stage forks gs.
+    fitz.TOOLS.store_shrink(100)
+    gc.collect()
+    _set_task_path(task, pymupdf_path)
+
+def _stage_ghostscript(task: Dict[str, Any]) -> None:
+    """
+    5) Ghostscript re-distill (biggest reduction usually happens here).
+    """
+    job_id = task["job_id"]
+    if not task["extreme_compression"]:
+        size = os.path.getsize(task["path"])
+        ratio = size / max(1, task.get("pre_image_bytes", size))
+        if size < GS_MIN_INPUT_BYTES and ratio > GS_SKIP_RATIO:
+            logger.info(
+                f"Job {job_id}: skipping Ghostscript ({size/1024/1024:.2f} MB, "
+                f"image stage kept {ratio:.0%} of size)"
+            )
+            return
+    _update_job(job_id, status="Applying Ghostscript compression...", progress=90)
+    _set_task_path(task, ghostscript_compress(task["path"], extreme=task["extreme_compression"]))
+
+def _stage_pikepdf(task: Dict[str, Any]) -> None:
+    """
+    6) PikePDF/QPDF optimize and linearize (fast web view).
+    """
+    job_id = task["job_id"]
+    _update_job(job_id, status="Optimizing final PDF structure...", progress=95)
+    _set_task_path(task, pikepdf_optimize(task["path"]))
+
+    # The job now owns the output file; it is removed by cleanup_old_jobs
+    output_path = task["path"]
+    task["path"] = task["input_pdf"]
+    if output_path != task["input_pdf"]:
+        # Only the output is served from here on; don't keep the upload until cleanup
+        cleanup_temp_file(task["input_pdf"])
+        _update_job(job_id, input_path=None)
+    # Size and log before publishing "done": once clients see it they may download the
+    # file, and cleanup_old_jobs may delete it, so nothing may touch it afterwards
+    logger.info(f"Job {job_id} complete. Final size: {os.path.getsize(output_path)/1024/1024:.2f} MB")
+    _update_job(job_id, status="done", progress=100, output_path=output_path, error=None)
+
+PIPELINE_STAGES = [_stage_subset, _stage_recompress_images, _stage_ghostscript, _stage_pikepdf]
+
+def _stage_worker_count(stage) -> int:
+    """
+    Threads serving a stage's queue. Bounded, so a burst of uploads waits in the
+    queues instead of running N pipelines at once, but more than one, so a single
+    huge upload does not hold every other job behind it in the same stage.
+    """
+    return max(1, min(PIPELINE_STAGE_WORKERS, _physical_cores()))
+
+_pipeline_lock = threading.Lock()
+_pipeline_queues: List["queue.Queue[Dict[str, Any]]"] = []
+
+def _stage_worker(stage, in_q: "queue.Queue[Dict[str, Any]]", out_q: Optional["queue.Queue[Dict[str, Any]]"]) -> None:
+    """
+    Run one pipeline stage forever: take a task, process it, hand it to the next stage.
+    A failing task is marked as errored and dropped from the pipeline.
+    """
+    while True:
+        task = in_q.get()
+        job_id = task["job_id"]
+        try:
+            stage(task)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+            _update_job(job_id, status="error", error=str(e))
+            _set_task_path(task, task["input_pdf"])
+            continue
+        if out_q is not None:
+            out_q.put(task)
+        else:
+            _set_task_path(task, task["input_pdf"])
+
+def _pipeline_input() -> "queue.Queue[Dict[str, Any]]":
+    """
+    Start the stage worker threads (and the job cleanup thread) on first use;
+    returns the first stage's queue.
+    """
+    with _pipeline_lock:
+        if not _pipeline_queues:
+            threading.Thread(target=cleanup_worker, name="cleanup", daemon=True).start()
+            queues = [queue.Queue() for _ in PIPELINE_STAGES]
+            for i, stage in enumerate(PIPELINE_STAGES):
+                out_q = queues[i + 1] if i + 1 < len(queues) else None
+                for n in range(_stage_worker_count(stage)):
+                    threading.Thread(
+                        target=_stage_worker,
+                        args=(stage, queues[i], out_q),
+                        name=f"pipeline{stage.__name__}-{n}",
+                        daemon=True,
+                    ).start()
+            _pipeline_queues.extend(queues)
+        return _pipeline_queues[0]
+
+def submit_job(
     job_id: str,
     input_pdf: str,
     quality: int,
@@ -677,136 +1765,32 @@ def process_job(
     drawing_mode: str,
     extract_pages: Optional[List[int]] = None,
     extreme_compression: bool = False,
+    fingerprint: Optional[str] = None,
 ) -> None:
-    try:
-        jobs[job_id]["status"] = "Initializing..."
-        jobs[job_id]["progress"] = 5
-
-        # 1) Open source and subset pages if requested
-        with fitz.open(input_pdf) as src:
-            if extract_pages:
-                keep = [p - 1 for p in extract_pages]  # incoming pages are 1-based
-                keep = [p for p in keep if 0 <= p < src.page_count]
-                if not keep:
-                    raise ValueError("No valid pages selected.")
-                status_label = f"Extracting {len(keep)} selected pages..."
-            else:
-                keep = list(range(src.page_count))
-                status_label = "Processing all pages..."
-
-            jobs[job_id]["status"] = status_label
-            jobs[job_id]["progress"] = 10
-
-            with fitz.open() as work:
-                for p in keep:
-                    try:
-                        # Some PDFs contain malformed link destinations like
-                        # "1&view=Fit" which PyMuPDF attempts to parse as a
-                        # page number and raises ValueError. Fall back to
-                        # copying the page without link metadata so the job
-                        # can still complete.
-                        work.insert_pdf(src, from_page=p, to_page=p)
-                    except ValueError as e:
-                        logger.warning(
-                            "Page %s has invalid link metadata; copying without links (%s)",
-                            p + 1,
-                            e,
-                        )
-                        work.insert_pdf(src, from_page=p, to_page=p, links=False)
-
-                # 2) Optional cleanup in extreme mode
-                if extreme_compression:
-                    jobs[job_id]["status"] = "Cleaning annotations & attachments..."
-                    jobs[job_id]["progress"] = 15
-                    try:
-                        for page in work:
-                            ann_iter = page.annots()
-                            if ann_iter:
-                                to_delete = []
-                                for a in ann_iter:
-                                    # Broadly remove visual annotations (safer size)
-                                    to_delete.append(a)
-                                for a in to_delete:
-                                    try:
-                                        page.delete_annot(a)
-                                    except Exception:
-                                        pass
-                    except Exception as e:
-                        logger.warning(f"Annot cleanup warning: {e}")
-
-                    # Remove embedded JS files if any
-                    try:
-                        count = work.embfile_count()
-                        for i in range(count - 1, -1, -1):
-                            info = work.embfile_info(i)
-                            fname = (info.get("filename") or "").lower() if info else ""
-                            if fname.endswith(".js"):
-                                logger.info(f"Removing embedded JS: {fname}")
-                                work.embfile_del(i)
-                    except Exception as e:
-                        logger.warning(f"Embed cleanup warning: {e}")
-
-                # 3) Image recompression
-                jobs[job_id]["status"] = "Recompressing images..."
-                jobs[job_id]["progress"] = 20
-                xrefs = _collect_unique_image_xrefs(work)
-                total = len(xrefs)
-                logger.info(f"Found {total} unique images.")
-                for idx, xref in enumerate(xrefs, start=1):
-                    try:
-                        base = work.extract_image(xref)
-                        img_bytes = base.get("image")
-                        if not img_bytes:
-                            continue
-                        with Image.open(io.BytesIO(img_bytes)) as im:
-                            new_bytes = _resample_image(
-                                pil_img=im,
-                                max_dim=max_dimension,
-                                mode=drawing_mode,
-                                quality=quality,
-                                extreme=extreme_compression,
-                            )
-                        # Replace just the stream (works across recent PyMuPDF versions)
-                        work.update_stream(xref, new_bytes)
-                    except Exception as e:
-                        logger.warning(f"Image xref {xref} recompress skipped: {e}")
-
-                    # progress to ~80%
-                    jobs[job_id]["progress"] = 20 + int((idx / max(1, total)) * 60)
-
-                # 4) Save intermediate bytes (compact structure)
-                jobs[job_id]["status"] = "Saving (PyMuPDF)..."
-                jobs[job_id]["progress"] = 82
-                interm = io.BytesIO()
-                # garbage >= 4 does aggressive xref cleanup; deflate compresses streams; clean removes unused
-                work.save(interm, garbage=4, deflate=True, clean=True)
-                pymupdf_bytes = interm.getvalue()
-
-        # 5) Ghostscript re-distill (biggest reduction usually happens here)
-        jobs[job_id]["status"] = "Applying Ghostscript compression..."
-        jobs[job_id]["progress"] = 90
-        gs_bytes = ghostscript_compress(pymupdf_bytes, extreme=extreme_compression)
-
-        # 6) PikePDF/QPDF optimize and linearize (fast web view)
-        jobs[job_id]["status"] = "Optimizing final PDF structure..."
-        jobs[job_id]["progress"] = 95
-        final_bytes = pikepdf_optimize(gs_bytes)
-
-        jobs[job_id].update({
-            "status": "done",
-            "progress": 100,
-            "output_buffer": io.BytesIO(final_bytes),
-            "error": None
-        })
-        logger.info(f"Job {job_id} complete. Final size: {len(final_bytes)/1024/1024:.2f} MB")
-
-    except Exception as e:
-        logger.error(f"Job {job_id} failed: {e}", exc_info=True)
-        jobs[job_id].update({"status": "error", "error": str(e)})
+    """
+    Queue a registered job (jobs[job_id]) for the processing pipeline.
+    fingerprint (see file_fingerprint) lets the pipeline reuse a cached parse of the input.
+    """
+    _pipeline_input().put({
+        "job_id": job_id,
+        "input_pdf": input_pdf,
+        "fingerprint": fingerprint,
+        "path": input_pdf,
+        "quality": quality,
+        "max_dimension": max_dimension,
+        "drawing_mode": drawing_mode,
+        "extract_pages": extract_pages,
+        "extreme_compression": extreme_compression,
+    })
 
 # -----------------------------
 # Routes
 # -----------------------------
+@app.teardown_request
+def _remove_unclaimed_uploads(exc: Optional[BaseException]) -> None:
+    for path in request.__dict__.get("upload_paths", ()):
+        cleanup_temp_file(path)
+
 @app.route("/")
 def index():
     return render_template_string(HTML_PAGE)
@@ -823,10 +1807,8 @@ def analyze():
 
     tmp = None
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as t:
-            tmp = t.name
-            f.save(t)
-        analysis = analyze_pdf_pages(tmp)
+        tmp = claim_upload(f)
+        analysis = analyze_pdf_pages(tmp, fingerprint=file_fingerprint(tmp))
         if not analysis:
             return jsonify(error="Failed to analyze PDF"), 500
         return jsonify(analysis)
@@ -854,51 +1836,91 @@ def compress():
         if extract_pages_str:
             extract_pages = [int(p) for p in extract_pages_str.split(",") if p.strip().isdigit()]
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as t:
-            inp_path = t.name
-            f.save(t)
+        inp_path = claim_upload(f)
+        fingerprint = file_fingerprint(inp_path)
 
         job_id = uuid.uuid4().hex
-        jobs[job_id] = {
-            "status": "queued",
-            "progress": 0,
-            "created_at": time.time(),
-            "input_path": inp_path,
-            "error": None,
-        }
+        with jobs_lock:
+            jobs[job_id] = {
+                "status": "queued",
+                "progress": 0,
+                "created_at": time.time(),
+                "input_path": inp_path,
+                "fingerprint": fingerprint,
+                "error": None,
+            }
 
-        th = threading.Thread(
-            target=process_job,
-            args=(job_id, inp_path, quality, max_dimension, drawing_mode, extract_pages, extreme_compression),
-            daemon=True,
+        submit_job(
+            job_id, inp_path, quality, max_dimension, drawing_mode, extract_pages, extreme_compression,
+            fingerprint=fingerprint,
         )
-        th.start()
         return jsonify(job_id=job_id)
     except Exception as e:
         logger.error(f"/compress error: {e}", exc_info=True)
         cleanup_temp_file(inp_path)
         return jsonify(error=str(e)), 500
 
+def _status_payload(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "status": job.get("status", "unknown"),
+        "progress": int(job.get("progress", 0)),
+        "error": job.get("error"),
+    }
+
 @app.route("/status/<job_id>")
 def status(job_id: str):
-    job = jobs.get(job_id)
+    job = _get_job(job_id)
     if not job:
         return jsonify({"error": "Job not found", "status": "error"}), 404
-    return jsonify({
-        "status": job.get("status", "unknown"),
-        "progress": int(job.get("progress", 0)),
-        "error": job.get("error"),
-    })
+    return jsonify(_status_payload(job))
+
+@app.route("/events/<job_id>")
+def events(job_id: str):
+    """
+    Server-Sent Events stream of a job's status: one event per change, ending
+    after done/error. /status stays available for clients without EventSource.
+    """
+    if _get_job(job_id) is None:
+        return jsonify({"error": "Job not found", "status": "error"}), 404
+
+    def current() -> Optional[Dict[str, Any]]:
+        job = jobs.get(job_id)
+        return _status_payload(job) if job is not None else None
+
+    def stream() -> Iterator[str]:
+        last = None
+        while True:
+            with jobs_changed:
+                jobs_changed.wait_for(lambda: current() != last, timeout=EVENTS_KEEPALIVE_SEC)
+                payload = current()
+            if payload is None:
+                yield f"data: {json.dumps({'status': 'error', 'progress': 0, 'error': 'Job not found'})}\n\n"
+                return
+            if payload == last:
+                yield ": keep-alive\n\n"
+                continue
+            last = payload
+            yield f"data: {json.dumps(payload)}\n\n"
+            if payload["status"] in ("done", "error"):
+                return
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.route("/download/<job_id>")
 def download(job_id: str):
-    job = jobs.get(job_id)
-    if not job or job.get("status") != "done" or not job.get("output_buffer"):
+    job = _get_job(job_id)
+    if not job or job.get("status") != "done" or not job.get("output_path"):
+        return jsonify(error="File not ready or found"), 404
+    if not os.path.exists(job["output_path"]):
         return jsonify(error="File not ready or found"), 404
-    buf: io.BytesIO = job["output_buffer"]
-    buf.seek(0)
+    # The upload has been fully processed; its cached parse is no longer needed
+    drop_source_document(job.get("fingerprint"))
     return send_file(
-        buf,
+        job["output_path"],
         as_attachment=True,
         download_name="extracted_drawing.pdf",
         mimetype="application/pdf"
@@ -908,12 +1930,20 @@ def download(job_id: str):
 # Cleanup worker
 # -----------------------------
 def cleanup_old_jobs(max_age_sec: int = 3600) -> None:
+    expire_source_documents()
     now = time.time()
-    to_remove = [jid for jid, j in jobs.items() if now - j.get("created_at", now) > max_age_sec]
-    for jid in to_remove:
+    with jobs_lock:
+        # Jobs still in the pipeline keep their files until they finish
+        to_remove = [
+            jid for jid, j in jobs.items()
+            if now - j.get("created_at", now) > max_age_sec and j.get("status") in ("done", "error")
+        ]
+        removed = [jobs.pop(jid) for jid in to_remove]
+    for jid, job in zip(to_remove, removed):
         try:
-            job = jobs.pop(jid, None)
-            if job and job.get("input_path"):
+            if job.get("output_path") and job.get("output_path") != job.get("input_path"):
+                cleanup_temp_file(job["output_path"])
+            if job.get("input_path"):
                 cleanup_temp_file(job["input_path"])
         except Exception as e:
             logger.warning(f"Cleanup error for job {jid}: {e}")
@@ -931,6 +1961,10 @@ def cleanup_worker():
 # -----------------------------
 if __name__ == "__main__":
     logger.info("Starting PDF Compressor for Architectural Drawings")
-    threading.Thread(target=cleanup_worker, daemon=True).start()
+    gs_exe = _find_ghostscript_exe()
+    if gs_exe:
+        logger.info(f"Using Ghostscript: {gs_exe}")
+    else:
+        logger.warning("Ghostscript not found in PATH; GS compression stage will be skipped.")
     # For production, set debug=False and run behind a WSGI server (gunicorn/uvicorn+ASGI via asgiref if desired)
     app.run(host="0.0.0.0", port=5001, debug=True)
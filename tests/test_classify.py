@@ -0,0 +1,23 @@
+import fitz
+import pytest
+
+import pdf_compressor as pc
+
+
+class _TextPage:
+    """Stands in for a fitz.Page whose extracted text keeps ligatures."""
+
+    rect = fitz.Rect(0, 0, 612, 792)
+
+    def __init__(self, text):
+        self.text = text
+
+    def get_text(self, *args, clip=None, **kwargs):
+        return "" if clip is not None else self.text
+
+
+@pytest.mark.parametrize("automaton", [None, pc._KEYWORD_AUTOMATON])
+def test_ligatures_match_keywords(monkeypatch, automaton):
+    monkeypatch.setattr(pc, "_KEYWORD_AUTOMATON", automaton)
+    assert pc.classify_page(_TextPage("second ﬂoor plan")) == "architectural"
+    assert pc.classify_page(_TextPage("ﬁre alarm riser")) == "fire_safety"
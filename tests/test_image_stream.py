@@ -0,0 +1,48 @@
+import io
+
+import fitz
+from PIL import Image
+
+import pdf_compressor as pc
+
+
+def _doc_with_images(count):
+    doc = fitz.open()
+    page = doc.new_page()
+    for i in range(count):
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 64), (255, 0, 0)).save(buf, "PNG")
+        page.insert_image(fitz.Rect(0, 80 * i, 64, 80 * i + 64), stream=buf.getvalue())
+    return doc, [img[0] for img in page.get_images()]
+
+
+def _encoded(mode):
+    img = Image.new("RGB", (32, 32), (0, 0, 255))
+    return pc._resample_image(img, 32, mode, 60, False)
+
+
+def test_explicit_mask_survives_replace_but_colour_key_does_not():
+    doc, (xref,) = _doc_with_images(1)
+    mask = doc.get_new_xref()
+    doc.update_object(mask, "<</Type/XObject/Subtype/Image/Width 1/Height 1/ImageMask true/BitsPerComponent 1>>")
+    doc.update_stream(mask, b"\x00")
+
+    doc.xref_set_key(xref, "Mask", f"{mask} 0 R")
+    pc._replace_image_stream(doc, xref, _encoded("mixed"))
+    assert doc.xref_get_key(xref, "Mask") == ("xref", f"{mask} 0 R")
+
+    doc.xref_set_key(xref, "Mask", "[0 10 0 10 0 10]")
+    pc._replace_image_stream(doc, xref, _encoded("mixed"))
+    assert doc.xref_get_key(xref, "Mask")[0] == "null"
+
+
+def test_copy_image_stream_matches_replaced_image():
+    for mode in ("mixed", "line_art"):
+        doc, (src, dst) = _doc_with_images(2)
+        pc._replace_image_stream(doc, src, _encoded(mode))
+        pc._copy_image_stream(doc, src, dst)
+        assert doc.xref_stream_raw(dst) == doc.xref_stream_raw(src)
+        for key in pc._REPLACED_IMAGE_KEYS:
+            assert doc.xref_get_key(dst, key) == doc.xref_get_key(src, key)
+        pix = fitz.Pixmap(doc, dst)
+        assert (pix.width, pix.height) == (32, 32)
@@ -0,0 +1,41 @@
+import io
+
+import fitz
+from PIL import Image
+
+import pdf_compressor as pc
+
+
+def _scan_page(doc):
+    page = doc.new_page(width=612, height=396)
+    buf = io.BytesIO()
+    Image.new("L", (2448, 1584), 200).save(buf, "JPEG")
+    page.insert_image(page.rect, stream=buf.getvalue())
+    return page
+
+
+def test_plain_scan_qualifies():
+    with fitz.open() as doc:
+        assert pc._scanned_page_image_size(_scan_page(doc)) == (2448, 1584)
+
+
+def test_vector_linework_over_scan_is_not_a_scan():
+    with fitz.open() as doc:
+        page = _scan_page(doc)
+        page.draw_line((10, 10), (500, 300))
+        assert pc._scanned_page_image_size(page) is None
+
+
+def test_annotated_scan_is_not_a_scan():
+    with fitz.open() as doc:
+        page = _scan_page(doc)
+        page.add_text_annot((50, 50), "check")
+        assert pc._scanned_page_image_size(page) is None
+
+
+def test_linked_scan_is_not_a_scan():
+    with fitz.open() as doc:
+        page = _scan_page(doc)
+        page.insert_link({"kind": fitz.LINK_URI, "from": fitz.Rect(10, 10, 100, 40), "uri": "https://example.com"})
+        page = doc.reload_page(page)
+        assert pc._scanned_page_image_size(page) is None
@@ -0,0 +1,50 @@
+import io
+
+import fitz
+
+import pdf_compressor as pc
+
+
+def _make_pdf(path, text):
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), text)
+        doc.save(path)
+
+
+def test_source_cache_evicts_beyond_capacity(tmp_path):
+    paths = []
+    for i in range(pc.SOURCE_DOC_CACHE_SIZE + 1):
+        path = str(tmp_path / f"doc{i}.pdf")
+        _make_pdf(path, f"A-{i} FLOOR PLAN")
+        paths.append(path)
+
+    for path in paths:
+        with pc.source_document(path, pc.file_fingerprint(path)) as doc:
+            assert doc.page_count == 1
+    assert len(pc._source_docs) == pc.SOURCE_DOC_CACHE_SIZE
+
+    # A cache full of stale entries must still expire cleanly
+    pc.expire_source_documents(max_age_sec=-1)
+    assert not pc._source_docs
+
+
+def test_analyze_more_files_than_cache_holds(tmp_path):
+    client = pc.app.test_client()
+    for i in range(pc.SOURCE_DOC_CACHE_SIZE + 1):
+        path = str(tmp_path / f"doc{i}.pdf")
+        _make_pdf(path, f"S-{i} FOUNDATION")
+        with open(path, "rb") as f:
+            data = f.read()
+        resp = client.post("/analyze", data={"file": (io.BytesIO(data), f"doc{i}.pdf")})
+        assert resp.status_code == 200
+        assert resp.get_json()["total_pages"] == 1
+    pc.expire_source_documents(max_age_sec=-1)
+
+
+def test_fingerprint_covers_the_middle_of_the_file(tmp_path):
+    a, b = tmp_path / "a.bin", tmp_path / "b.bin"
+    body = bytearray(b"x" * (512 * 1024))
+    a.write_bytes(bytes(body))
+    body[256 * 1024] = ord("y")
+    b.write_bytes(bytes(body))
+    assert pc.file_fingerprint(str(a)) != pc.file_fingerprint(str(b))